@@ -37,12 +37,30 @@ python3 NanoporeRealTimeSimulator.py -i SampleReads.fastq.gz
 ###########################################################################
 
 #Import libraries
-import datetime
+import contextlib
+import functools
 import gzip
+import io
 import sys
 import os
 import argparse
-import shutil
+import array
+import bisect
+import itertools
+import queue
+import tempfile
+import threading
+
+# Optional libraries for parallel decompression of the input file and
+# faster compression of the output files, both fall back to gzip
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
 
 ###########################################################################
 # FUNCTIONS
@@ -85,6 +103,231 @@ def stringConvert_intList(inputString):
 
     return intList
 
+def parse_fastq(buffer):
+    """
+        Parses all complete reads in a buffer of decompressed fastq data, in one pass.
+        Lines are located with bytes.find, and each read is returned as offsets into
+        the buffer, so the reads are not copied while parsing. A read that is only partly
+        contained in the buffer is left for the next buffer.
+        The timestamp is found by searching the header for start_time=, as its position
+        among the header fields differs between basecaller versions.
+        
+        parameters:
+            buffer = Decompressed fastq data as bytes or bytearray
+        returns:
+            parsed_reads = List of reads as (timestamp, number of bases, start, end),
+                           where start and end are the offsets of the read in the buffer
+            start = Offset of the first read not parsed
+        raises:
+            ValueError = If a read header has no start_time
+    """
+    parsed_reads = list()
+    find = buffer.find
+    start = 0
+    while True:
+        # Find the end of the header, sequence, separator and quality line
+        header_end = find(b'\n', start)
+        if header_end == -1:
+            break
+        sequence_end = find(b'\n', header_end+1)
+        if sequence_end == -1:
+            break
+        separator_end = find(b'\n', sequence_end+1)
+        if separator_end == -1:
+            break
+        quality_end = find(b'\n', separator_end+1)
+        if quality_end == -1:
+            break
+        time_start = find(b'start_time=', start, header_end)
+        if time_start == -1:
+            raise ValueError(bytes(buffer[start:header_end]).decode('ascii', 'replace'))
+        time_string = buffer[time_start+11:time_start+31]
+        parsed_reads.append((time_string, sequence_end-header_end-1, start, quality_end+1))
+        start = quality_end+1
+    
+    return parsed_reads, start
+
+def timestamp_convert(time_string, minute_cache):
+    """
+        Converts a timestamp in the fixed format YYYY-MM-DDTHH:MM:SSZ to seconds
+        since 1970-01-01, by reading the digits at their known positions.
+        This is much faster than datetime.strptime, which is called once per read.
+        Many reads are sequenced within the same minute, so the conversion of
+        everything but the seconds is only done once per minute, and cached.
+        
+        parameters:
+            time_string = Timestamp as bytes, e.g. b'2019-05-06T13:02:27Z'
+            minute_cache = Dictionary of minutes already converted, shared between calls
+        returns:
+            seconds = Timestamp as seconds since 1970-01-01 (UTC)
+    """
+    minute = bytes(time_string[0:16])
+    if minute in minute_cache:
+        return minute_cache[minute] + int(time_string[17:19])
+    
+    year = int(time_string[0:4])
+    month = int(time_string[5:7])
+    day = int(time_string[8:10])
+    
+    # Days since 1970-01-01 in the Gregorian calendar, counting years from March
+    # so that the leap day is the last day of the year
+    if month <= 2:
+        year -= 1
+        month += 9
+    else:
+        month -= 3
+    era = year // 400
+    year_of_era = year - era*400
+    day_of_year = (153*month + 2)//5 + day-1
+    day_of_era = year_of_era*365 + year_of_era//4 - year_of_era//100 + day_of_year
+    days = era*146097 + day_of_era - 719468
+    
+    minute_cache[minute] = days*86400 + int(time_string[11:13])*3600 + int(time_string[14:16])*60
+    seconds = minute_cache[minute] + int(time_string[17:19])
+    
+    return seconds
+
+def seconds_convert(seconds):
+    """
+        Converts a number of seconds to a string of hours, minutes and seconds.
+        Hours are not limited to 24, so runs longer than a day are shown in full.
+        
+        parameters:
+            seconds = Number of seconds as int
+        returns:
+            time_string = Time as HH:MM:SS
+    """
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    
+    return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+def gzip_open(filename, buffer_size=1 << 17):
+    """
+        Opens a gzip file for reading. If rapidgzip is installed, the file is
+        decompressed in parallel on all cores. Otherwise gzip is used, with a
+        larger read buffer than the default, as fewer and larger reads from the
+        decompressor reduce the overhead per line.
+        
+        parameters:
+            filename = Path to gzip file
+            buffer_size = Size of the read buffer in bytes
+        returns:
+            infile = Buffered binary file object with the decompressed data
+    """
+    if rapidgzip is not None:
+        return rapidgzip.open(filename, parallelization=os.cpu_count())
+    
+    return io.BufferedReader(gzip.GzipFile(filename, 'rb'), buffer_size=buffer_size)
+
+def open_member(fileobj, compress, threads=-1):
+    """
+        Opens a writer for a member of the output files, that is a slice of reads
+        which is written once and then appended to each output file containing it.
+        Closing the writer does not close the file object.
+        
+        parameters:
+            fileobj = Binary file object to write the member to
+            compress = Whether the member is gzip compressed
+            threads = Number of compression threads, as for gzip_writer
+        returns:
+            memberfile = Context manager returning a binary file object to write reads to
+    """
+    if compress:
+        return gzip_writer(fileobj, threads)
+    
+    return contextlib.nullcontext(fileobj)
+
+def read_blocks(infile, block_size, queue_size=4):
+    """
+        Reads a file in blocks on a background thread, so decompression of the
+        next blocks overlaps with parsing of the current block. zlib releases
+        the GIL while decompressing, so the two run in parallel.
+        
+        parameters:
+            infile = Binary file object to read from
+            block_size = Number of bytes to read at a time
+            queue_size = Maximum number of blocks read ahead
+        yields:
+            block = Next block of data, the last block is empty
+    """
+    blocks = queue.Queue(maxsize=queue_size)
+    
+    def producer():
+        try:
+            while True:
+                block = infile.read(block_size)
+                blocks.put(block)
+                if not block:
+                    break
+        except Exception as error:
+            # Raised again in the consuming thread
+            blocks.put(error)
+    
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    while True:
+        block = blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        yield block
+        if not block:
+            break
+    thread.join()
+
+def gzip_writer(fileobj, threads=-1):
+    """
+        Opens a gzip writer on a binary file object, at compression level 1,
+        which is much faster than the default level 9 and compresses fastq
+        almost as well. If isal is installed, its faster deflate
+        implementation is used, by default with one compression thread per core.
+        Closing the writer does not close the file object.
+        
+        parameters:
+            fileobj = Binary file object to write the compressed data to
+            threads = Number of isal compression threads, -1 for one per core,
+                      0 to compress in the calling thread
+        returns:
+            gzfile = Binary file object that compresses data written to it
+    """
+    if igzip_threaded is not None:
+        return igzip_threaded.open(fileobj, 'wb', compresslevel=1, threads=threads)
+    
+    return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=1)
+
+def read_fastq(filename, block_size=1 << 17):
+    """
+        Goes through the reads of a fastq.gz file. The file is decompressed in
+        blocks on a background thread, and all complete reads in a block are
+        parsed at once.
+        
+        parameters:
+            filename = Path to fastq.gz file
+            block_size = Number of decompressed bytes to read at a time
+        yields:
+            buffer = Decompressed data containing the parsed reads, only valid
+                     until the next block is yielded
+            parsed_reads = Reads in the buffer, as returned by parse_fastq
+    """
+    with gzip_open(filename) as infile:
+        # Decompressed data not parsed yet. Blocks are appended to it and parsed reads are removed
+        # from the front, which bytearray does in place instead of building a new buffer per block.
+        buffer = bytearray()
+        for block in read_blocks(infile, block_size):
+            if not block:
+                # Last read in the file may lack the final newline
+                block = b'\n'
+            buffer += block
+            try:
+                parsed_reads, end = parse_fastq(buffer)
+            except ValueError as error:
+                sys.exit('No start_time found in read header:\n{}\nof input file:\n{}'.format(error, filename))
+            yield buffer, parsed_reads
+            del buffer[:end]
+    
+    if buffer.strip():
+        sys.exit('Input file:\n{}\nends with an incomplete read.'.format(filename))
+
 ###########################################################################
 # GET INPUT
 ###########################################################################
@@ -123,6 +366,14 @@ group.add_argument('-sl', type=str, dest='size_list',
                     'Basesizes should be comma-delimitered numbers. '
                     'Basesizes can be listed as bp, Kbp (K), Mbp (M) or Gbp (G).')
 
+# Optional arguments
+parser.add_argument('--no-gzip-output', dest='no_gzip_output', action='store_true',
+                    help='Write the output files as uncompressed .fastq files instead of .fastq.gz files.')
+parser.add_argument('--low-memory', dest='low_memory', action='store_true',
+                    help='Only keep the timestamp and number of bases of each read in memory, and read the input '
+                    'file a second time to write the output files. The reads added to each output file are '
+                    'then written in the order of the input file, instead of sorted by timestamp.')
+
 args = parser.parse_args()
 
 ###########################################################################
@@ -191,96 +442,63 @@ os.makedirs(args.output_folder, exist_ok=True)
 # Load all reads into memory and sort them based on their timestamp
 ###########################################################################  
 
-# Initialize variables
-reads = list()
-sequence_flag = 0
+# Initialize variables, the reads are stored as three parallel arrays
+read_times = array.array('q')  # Timestamps in seconds
+read_bases = array.array('q')  # Number of bases in each read
+read_data = list()             # Total read including header, not used with --low-memory
 total_bases = 0
-
-# Check for placement of timestamp in read headers, due to potential difference in header versions.
-# Albacore and new Guppy versions has the time at index 4 (0-based indexing)
-# Older Guppy versions had the time at index 5.
-with gzip.open(args.input_filename, 'r') as infile:           
-    for line in infile:
-        if line.startswith(b'@') and b'start_time' in line: 
-            headerSplit = line.split(b" ")
-            break
-    for i, element in enumerate(headerSplit):
-        if b'start_time' in element:
-            time_index = i
-        
-            
-# Go through each read, save the timestamp, number of bases and the total read including header
-with gzip.open(args.input_filename, 'r') as infile:           
-    for line in infile:
-        # Sequence - Count bases
-        if sequence_flag == 1:
-            bases = len(line)-1
-            total_bases += bases
-            reads[-1][1] = bases
-            sequence_flag = 0
-        # Header - Save timestamp
-        if line.startswith(b'@') and b'start_time' in line:      
-            time_string = line.split()[time_index].split(b'=')[1].decode('ascii')   # Get time from timestamp in header
-            time = datetime.datetime.strptime(time_string, '%Y-%m-%dT%H:%M:%SZ')
-            reads.append([time,None,b'']) # Time, number of bases in read, total read
-            sequence_flag = 1
-        # Save line for output later
-        reads[-1][2] += line
+minute_cache = dict()          # Seconds since 1970-01-01 for each minute in the read timestamps
+
+# Go through each read, save the timestamp, number of bases and the total read including header.
+# With --low-memory the total read is not saved, it is read again from the input file when writing the output.
+for buffer, parsed_reads in read_fastq(args.input_filename):
+    for time_string, bases, start, stop in parsed_reads:
+        time = timestamp_convert(time_string, minute_cache)
+        total_bases += bases
+        read_times.append(time)
+        read_bases.append(bases)
+        if not args.low_memory:
+            read_data.append(buffer[start:stop])
  
-# Sort reads based on timestamp        
-reads.sort()
+# Sort reads based on timestamp only, reads with the same timestamp keep their order from the input file
+order = array.array('q', sorted(range(len(read_times)), key=read_times.__getitem__))
+read_times = array.array('q', [read_times[i] for i in order])
+read_bases = array.array('q', [read_bases[i] for i in order])
+if not args.low_memory:
+    read_data = [read_data[i] for i in order]
+    del order
 
 ###########################################################################
 # Figure out the subsets of reads to include in each output file
 ###########################################################################  
 reads_output = list()   # Fill with the number of reads required to reach each value in the input list
-counter = 0 
 
-# Coverage or Size
-if mode == "coverage" or mode == "size":
-    # Create list of required number of bases for each element in input list
-    if mode == "coverage":
-        required_bp = [i * genome_size for i in args.coverage_list]
-    elif mode == "size":
-        required_bp = size_list_converted
-        
-    total_bp = 0
-    # Go through each read     
-    for i in range(len(reads)): 
-        read_bp = reads[i][1]
-        total_bp += read_bp
-    
-        # When reads containing enough bases to reach the requirement is found,
-        # then continue to next element in the list.
-        if total_bp > required_bp[counter]:
-            reads_output.append([input_list[counter],i])
-            counter += 1
-        
-            # Reads to complete all elements in the input list are found, no need to continue
-            if total_bp > required_bp[-1]:
-                break 
-
-# Time
-if mode == "time":
-    start_time = reads[0][0]
-    # Go through each read     
-    for i in range(len(reads)): 
-        read_time = reads[i][0]
-        total_time = read_time-start_time   # Time since start
-        # Convert to minutes
-        if total_time.days == 0:
-            total_time_minutes = total_time.seconds/60
-        else:
-            total_time_minutes = (total_time.days*24*60)+(total_time.seconds)/60
-    
-        # When time since start reaches a time in the time interval list, continue to next element in the list
-        if total_time_minutes > input_list[counter]:
-            reads_output.append([input_list[counter],i-1])
-            counter += 1
-        
-            # Reads for the given time intervals are found, no need to continue
-            if total_time_minutes > input_list[-1]:
-                break 
+# Total number of bases up to and including each read
+cumulative_bases = array.array('q', itertools.accumulate(read_bases))
+
+# Each element in the input list is a threshold on a sorted value of the reads,
+# the total number of bases for coverage and size, or the timestamp for time.
+# Coverage and size include the read that exceeds the threshold, time stops before it.
+if mode == "coverage":
+    thresholds = [i * genome_size for i in args.coverage_list]
+    read_values = cumulative_bases
+    index_offset = 0
+elif mode == "size":
+    thresholds = size_list_converted
+    read_values = cumulative_bases
+    index_offset = 0
+elif mode == "time":
+    thresholds = [read_times[0] + i*60 for i in args.time_list]
+    read_values = read_times
+    index_offset = -1
+
+for i in range(len(thresholds)):
+    # Index of the first read exceeding the threshold
+    read_index = bisect.bisect_right(read_values, thresholds[i])
+    # No reads exceed this or later elements in the list
+    if read_index == len(read_values):
+        break
+    reads_output.append([input_list[i],read_index+index_offset])
   
 ###########################################################################
 # Create output files
@@ -290,31 +508,71 @@ if mode == "time":
 isolate_filename = os.path.basename(args.input_filename)
 isolate = '.'.join(isolate_filename.split('.')[0:-2]) # To not include .fastq.gz
 output_filenames = list()
-affix_list = list() # Append 0's in front of values to make all values equal in length
-affix_len = len(str(reads_output[-1][0]))
+output_extension = 'fastq' if args.no_gzip_output else 'fastq.gz'
+padded_values = list() # Append 0's in front of values to make all values equal in length
+value_width = len(str(reads_output[-1][0]))
 for i in range(len(reads_output)):
-    value = reads_output[i][0]
-    value_len = len(str(value))
-    affix = (affix_len-value_len)*"0"
-    output_filenames.append('{}{}.{}_{}{}.fastq.gz'.
-                                    format(args.output_folder,isolate,mode,affix,value))
-    affix_list.append(affix)
+    padded_values.append('{:0>{}}'.format(reads_output[i][0], value_width))
+    output_filenames.append('{}{}.{}_{}.{}'.
+                                    format(args.output_folder,isolate,mode,padded_values[i],output_extension))
           
-# Write to first file
-with gzip.open(output_filenames[0], 'w') as outfile:
-    first_read_index = 0
-    last_read_index = reads_output[0][1]
-    for i in range(first_read_index,last_read_index+1):
-        outfile.write(reads[i][2])
+# Write all output files in one go. Each file contains the reads of the previous file plus the
+# reads added since then. The new reads are compressed once, as a gzip member, which is then appended
+# to all files that should contain them, instead of copying the previous file and appending to it.
+# Without gzip output, the reads are written directly to each file, as there is nothing to share.
+with contextlib.ExitStack() as stack:
+    outfiles = [stack.enter_context(open(filename, 'wb')) for filename in output_filenames]
+    
+    if not args.low_memory:
+        last_read_index = -1
+        for i in range(len(reads_output)):
+            first_read_index = last_read_index+1
+            last_read_index = reads_output[i][1]
+            if args.no_gzip_output:
+                for j in range(first_read_index,last_read_index+1):
+                    for outfile in outfiles[i:]:
+                        outfile.write(read_data[j])
+            else:
+                member = io.BytesIO()
+                with gzip_writer(member) as memberfile:
+                    for j in range(first_read_index,last_read_index+1):
+                        memberfile.write(read_data[j])
+                for outfile in outfiles[i:]:
+                    outfile.write(member.getbuffer())
+    
+    # With --low-memory, the reads are read again from the input file. They are not in timestamp order
+    # there, so all members are written at the same time, to temporary files in the output folder.
+    else:
+        # Member of each read, in the order of the input file. Reads not included in any output file
+        # get the number of members.
+        read_members = array.array('q', [len(reads_output)]) * len(order)
+        last_read_index = -1
+        for i in range(len(reads_output)):
+            first_read_index = last_read_index+1
+            last_read_index = reads_output[i][1]
+            for j in range(first_read_index,last_read_index+1):
+                read_members[order[j]] = i
         
-# Copy last file and append to it            
-for i in range(1,len(reads_output)):
-    shutil.copyfile(output_filenames[i-1], output_filenames[i])
-    first_read_index = last_read_index+1
-    last_read_index = reads_output[i][1]
-    with gzip.open(output_filenames[i], 'a') as outfile:
-        for j in range(first_read_index,last_read_index+1):
-            outfile.write(reads[j][2])
+        # A member is open for each output file at the same time, so each is compressed
+        # in the calling thread instead of starting compression threads for every member
+        members = [stack.enter_context(tempfile.TemporaryFile(dir=args.output_folder))
+                   for i in range(len(reads_output))]
+        with contextlib.ExitStack() as member_stack:
+            memberfiles = [member_stack.enter_context(open_member(member, not args.no_gzip_output, threads=0))
+                           for member in members]
+            read_index = 0
+            for buffer, parsed_reads in read_fastq(args.input_filename):
+                for time_string, bases, start, stop in parsed_reads:
+                    i = read_members[read_index]
+                    if i < len(memberfiles):
+                        memberfiles[i].write(buffer[start:stop])
+                    read_index += 1
+        
+        for i in range(len(members)):
+            members[i].seek(0)
+            for chunk in iter(functools.partial(members[i].read, 1 << 20), b''):
+                for outfile in outfiles[i:]:
+                    outfile.write(chunk)
           
 # Write summary information file
 outfilename = ('{}{}.{}_stats.txt'.format(args.output_folder, isolate, mode))
@@ -322,9 +580,9 @@ with open(outfilename, 'w') as outfile:
     
     # Output general information
     outfile.write('Input file: ' + args.input_filename)
-    first_read_time = reads[0][0]
-    last_read_time = reads[-1][0]
-    total_time = (datetime.datetime.min + (last_read_time-first_read_time)).time()
+    first_read_time = read_times[0]
+    last_read_time = read_times[-1]
+    total_time = seconds_convert(last_read_time-first_read_time)
     outfile.write('\nTotal sequencing time: {}'.format(total_time))
     outfile.write('\nTotal bases in file: {}'.format(total_bases))
     
@@ -343,22 +601,16 @@ with open(outfilename, 'w') as outfile:
     if mode == "coverage" or mode == "size":
         for i in range(len(reads_output)):
             read_index = reads_output[i][1] # Index of last included read
-            last_read_time = reads[read_index][0]   # Timestamp for last included read     
-            time_since_start = (datetime.datetime.min + (last_read_time-first_read_time)).time()
-            outfile.write('{}{}: {} \n'.format(affix_list[i],input_list[i],time_since_start))
+            last_read_time = read_times[read_index]   # Timestamp for last included read     
+            time_since_start = seconds_convert(last_read_time-first_read_time)
+            outfile.write('{}: {} \n'.format(padded_values[i],time_since_start))
     
     # Output number of bases for each given time
     if mode == "time":
-        basecount = 0    
         for i in range(len(reads_output)): 
             # Count and output bases for each time in the time list
-            if i > 0:
-                first_read_index = reads_output[i-1][1]+1
-            else:
-                first_read_index = 0
             last_read_index = reads_output[i][1]
-            # Calculate bases in reads added between previous time and now
-            bases = sum([reads[x][1] for x in range(first_read_index,last_read_index+1)])
-            basecount += bases
+            # No reads are included if the first read is already later than the time
+            basecount = cumulative_bases[last_read_index] if last_read_index >= 0 else 0
             basecount_string = str(basecount/1000000)+"Mbp"
-            outfile.write('{}{}: {} \n'.format(affix_list[i],input_list[i],basecount_string))
+            outfile.write('{}: {} \n'.format(padded_values[i],basecount_string))